@@ -11,6 +11,5 @@ if __name__ == '__main__':
     )
     
     converter.convert_to_onnx()
-    converter.optimize_onnx_model()
     converter.quantize_onnx_model()
     
\ No newline at end of file
@@ -10,3 +10,4 @@ if __name__ == '__main__':
     text_translated = model.translate(TEXT)
 
     save_txt('data/test_text_translated_onnx.txt', text_translated)
+    print(f"Matches torch translation: {text_translated == read_txt('data/test_text_translated.txt')}")
@@ -4,18 +4,20 @@ import time
 import numpy as np
 
 from transformers import MarianTokenizer, MarianMTModel
+from onnxruntime import get_available_providers
 
 from src.utils import read_txt
-from src.config import NAME, REGEX, ITERATIONS
+from src.config import NAME, REGEX, ITERATIONS, FP16_PROVIDERS
 from src.models import TranslationModelOnnx
 
 
 TEXT = read_txt('data/test_text.txt')
 
-def warm_up(model_torch, model_onnx, batches):
+def warm_up(model_torch, models_onnx, batches):
     for _ in range(10):
         model_torch.generate(**batches)
-        model_onnx.generate(batches)
+        for model_onnx in models_onnx:
+            model_onnx.generate(batches)
 
 def measure_time_torch(model, batches, iterations):
     times = []
@@ -46,13 +48,24 @@ if __name__ == '__main__':
     tokenizer = MarianTokenizer.from_pretrained(NAME)
     model_torch = MarianMTModel.from_pretrained(NAME)
     model_onnx = TranslationModelOnnx(model_torch.config)
+    # fp16 graphs only pay off on an execution provider with fp16 kernels
+    fp16_available = FP16_PROVIDERS[0] in get_available_providers()
+    models_onnx = [model_onnx]
+    if fp16_available:
+        model_onnx_fp16 = TranslationModelOnnx(model_torch.config, variant='opt.fp16', providers=FP16_PROVIDERS)
+        models_onnx.append(model_onnx_fp16)
 
     sentences = re.split(REGEX, TEXT)
     batches = tokenizer.prepare_seq2seq_batch(sentences, return_tensors="pt")
 
-    warm_up(model_torch, model_onnx, batches)
+    warm_up(model_torch, models_onnx, batches)
     torch_times = measure_time_torch(model_torch, batches, ITERATIONS)
     onnx_times = measure_time_onnx(model_onnx, batches, ITERATIONS)
 
     print(f"Torch latency: {np.around(np.mean(torch_times), 2)} ms")
     print(f"ONNX latency: {np.around(np.mean(onnx_times), 2)} ms")
+    if fp16_available:
+        onnx_fp16_times = measure_time_onnx(model_onnx_fp16, batches, ITERATIONS)
+        print(f"ONNX fp16 latency ({FP16_PROVIDERS[0]}): {np.around(np.mean(onnx_fp16_times), 2)} ms")
+    else:
+        print(f"ONNX fp16 latency: skipped, {FP16_PROVIDERS[0]} is not available")
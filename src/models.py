@@ -1,6 +1,6 @@
 import re
 import numpy as np
-from transformers import MarianMTModel, MarianTokenizer
+from transformers import MarianConfig, MarianMTModel, MarianTokenizer
 
 from onnxruntime import InferenceSession
 
@@ -36,88 +36,86 @@ class TranslatorTorch():
 
 
 class TranslationEncoderOnnx:
-    def __init__(self):
+    def __init__(self, variant='opt.quant', providers=('CPUExecutionProvider',)):
         super().__init__()
-        self.encoder_session = InferenceSession("onnx/encoder.opt.quant.onnx", providers=['CPUExecutionProvider'])
+        self.encoder_session = InferenceSession(f"onnx/encoder.{variant}.onnx", providers=list(providers))
 
     def __call__(self, input_ids, attention_mask):
         onnx_inputs = {
             'input_ids': input_ids,
             'attention_mask': attention_mask
         }
-        hidden = self.encoder_session.run(None, onnx_inputs)
-        return hidden[0]
+        cross_past_key_values = self.encoder_session.run(None, onnx_inputs)
+        return cross_past_key_values
 
 
 class TranslationDecoderOnnx:
-    def __init__(self):
+    def __init__(self, variant='opt.quant', providers=('CPUExecutionProvider',)):
         super().__init__()
-        self.decoder_session = InferenceSession("onnx/decoder.opt.quant.onnx", providers=['CPUExecutionProvider'])
-        self.decoder_pkv_session = InferenceSession("onnx/decoder_pkv.opt.quant.onnx", providers=['CPUExecutionProvider'])
-        self.lm_head_session = InferenceSession("onnx/lm_head.opt.quant.onnx", providers=['CPUExecutionProvider'])
-
-    def __call__(self, input_ids, encoder_outputs, encoder_attention_mask, past_key_values=None):
-        if past_key_values:
-            decoder_names = ['input_ids', 'encoder_attention_mask']
-            decoder_inputs = [input_ids, encoder_attention_mask]
-            decoder_onnx_inputs = dict(zip(decoder_names + self.pkv_names, decoder_inputs + past_key_values))
-
-            output = self.decoder_pkv_session.run(None, decoder_onnx_inputs)
-            hidden = output[0]
-            pkv = output[1:]
-        else:
-            decoder_onnx_inputs = {
-                'input_ids': input_ids,
-                'encoder_hidden_states': encoder_outputs,
-                'encoder_attention_mask': encoder_attention_mask
-            }
-            output = self.decoder_session.run(None, decoder_onnx_inputs)
-            hidden = output[0]
-            pkv = output[1:]
-
-            self.pkv_names = [f"pkv_{i}" for i in range(len(pkv))]
+        self.decoder_session = InferenceSession(f"onnx/decoder.{variant}.onnx", providers=list(providers))
+        self.lm_head_session = InferenceSession(f"onnx/lm_head.{variant}.onnx", providers=list(providers))
+
+        self.pkv_names = [i.name for i in self.decoder_session.get_inputs() if i.name.startswith('pkv_')]
+        self.cross_pkv_names = [i.name for i in self.decoder_session.get_inputs() if i.name.startswith('cross_pkv_')]
+
+    def decode(self, input_ids, encoder_attention_mask, past_key_values, cross_past_key_values):
+        decoder_names = ['input_ids', 'encoder_attention_mask'] + self.pkv_names + self.cross_pkv_names
+        decoder_inputs = [input_ids, encoder_attention_mask] + past_key_values + cross_past_key_values
+        decoder_onnx_inputs = dict(zip(decoder_names, decoder_inputs))
+
+        output = self.decoder_session.run(None, decoder_onnx_inputs)
+        hidden = output[0]
+        pkv = output[1:]
 
         summed = np.sum(hidden, 1)
         hidden_masked = np.expand_dims(summed, 1)
+        return hidden_masked, pkv
 
+    def lm_head(self, hidden_masked):
         lm_head_onnx_inputs = {'input': hidden_masked}
         output = self.lm_head_session.run(None, lm_head_onnx_inputs)
-        return output[0], pkv
+        return output[0]
 
 
 class TranslationModelOnnx:
-    def __init__(self, config, max_length=100):
-        self.encoder = TranslationEncoderOnnx()
-        self.decoder = TranslationDecoderOnnx()
+    def __init__(self, config, max_length=100, variant='opt.quant', providers=('CPUExecutionProvider',)):
+        self.encoder = TranslationEncoderOnnx(variant, providers)
+        self.decoder = TranslationDecoderOnnx(variant, providers)
         self.config = config
         self.max_length = max_length
 
-    def generate(self, tokens):
-        enc_inputs, enc_att_mask = tokens['input_ids'].numpy(), tokens['attention_mask'].numpy()
-        hidden = self.encoder(enc_inputs, enc_att_mask)
+        self.n_heads = self.config.decoder_attention_heads
+        self.d_k = self.config.d_model//self.n_heads
+
+    def _empty_past_key_values(self, bsz):
+        pkv = np.zeros((bsz, self.n_heads, 0, self.d_k), np.float32)
+        return [pkv]*len(self.decoder.pkv_names)
+
+    def generate(self, tokens, decoder_states=None):
+        enc_inputs = tokens['input_ids'].numpy().astype(np.int32)
+        enc_att_mask = tokens['attention_mask'].numpy().astype(np.int32)
+        cross_past_key_values = self.encoder(enc_inputs, enc_att_mask)
 
         bsz = enc_inputs.shape[0]
 
         indices_active = np.arange(enc_inputs.shape[0])
-        dec_inputs = np.ones((bsz, self.max_length), int)*self.config.pad_token_id
+        dec_inputs = np.ones((bsz, self.max_length), np.int32)*self.config.pad_token_id
         dec_inputs[:, 0] = self.config.decoder_start_token_id
 
-        past_key_values = None
+        past_key_values = self._empty_past_key_values(bsz)
 
         for idx in range(self.max_length - 1):
-            if past_key_values:
-                logits, past_key_values = self.decoder(
-                    dec_inputs[indices_active, idx].reshape(-1, 1),
-                    hidden[indices_active, :],
-                    enc_att_mask[indices_active, :],
-                    past_key_values
-                )
-            else:
-                logits, past_key_values = self.decoder(
-                    dec_inputs[indices_active, idx].reshape(-1, 1),
-                    hidden[indices_active, :],
-                    enc_att_mask[indices_active, :],
-                )
+            hidden_masked, past_key_values = self.decoder.decode(
+                dec_inputs[indices_active, idx].reshape(-1, 1),
+                enc_att_mask[indices_active, :],
+                past_key_values,
+                cross_past_key_values
+            )
+
+            if decoder_states is not None:
+                decoder_states.append(hidden_masked)
+            logits = self.decoder.lm_head(hidden_masked)
+
             logits[:, 0, self.config.pad_token_id] = float("-inf")
             token_ids = logits.argmax(axis=2).flatten()
             dec_inputs[indices_active, idx + 1] = token_ids
@@ -128,17 +126,19 @@ class TranslationModelOnnx:
             if indices_active.size == 0:
                 break
 
-            past_key_values = [pkv[indices_non_end, :, :, :] for pkv in past_key_values]
+            if indices_non_end.size < token_ids.size:
+                past_key_values = [pkv[indices_non_end, :, :, :] for pkv in past_key_values]
+                cross_past_key_values = [pkv[indices_non_end, :, :, :] for pkv in cross_past_key_values]
         return dec_inputs[:, :idx + 2]
 
 
 class TranslatorOnnx():
-    def __init__(self, name, split_regex):
+    def __init__(self, name, split_regex, variant='opt.quant'):
         self.split_regex = split_regex
         self.tokenizer = MarianTokenizer.from_pretrained(name)
 
-        config_file = MarianMTModel.from_pretrained(name).config
-        self.model = TranslationModelOnnx(config_file)
+        config_file = MarianConfig.from_pretrained(name)
+        self.model = TranslationModelOnnx(config_file, variant=variant)
     
     def _prepare_text(self, text):
         text_filtered = text.replace('\n', ' ').strip()
@@ -150,3 +150,10 @@ class TranslatorOnnx():
         batches_translated = self.model.generate(batches)
         sentences_translated = [self.tokenizer.decode(s, skip_special_tokens=True) for s in batches_translated]
         return " ".join(sentences_translated)
+
+    def decoder_states(self, text):
+        sentences = self._prepare_text(text)
+        batches = self.tokenizer.prepare_seq2seq_batch(sentences, return_tensors="pt")
+        decoder_states = []
+        self.model.generate(batches, decoder_states)
+        return decoder_states
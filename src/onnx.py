@@ -1,16 +1,324 @@
-import functools
-import operator
-from copy import deepcopy
+import gc
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 import torch
-from transformers import MarianMTModel
+from transformers import MarianConfig, MarianMTModel
 
 import onnx
 import onnxruntime
-from onnxruntime.quantization import QuantizationMode, quantize
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quantize_dynamic,
+    quantize_static,
+)
+from onnxruntime.tools.symbolic_shape_infer import SymbolicShapeInference
+from onnxruntime.transformers.optimizer import optimize_model
+
+from src.config import ATOL, CALIBRATION_PATH, REGEX
+from src.models import TranslatorOnnx
+from src.utils import read_txt
+from src.wrappers import MarianDecoderWrapped, MarianEncoderWrapped, MarianLmHeadWrapped
+
+
+def load_model(name):
+    return MarianMTModel.from_pretrained(name, low_cpu_mem_usage=True, torch_dtype=torch.float32)
+
+
+def optimize_exported_model(name, buffer, num_heads, hidden_size):
+    model_proto = onnx.load_model_from_string(buffer.getvalue())
+    optimized_model = optimize_model(
+        model_proto,
+        model_type='bart',
+        num_heads=num_heads,
+        hidden_size=hidden_size,
+        opt_level=1,
+    )
+    # ONNX shape inference, which the quantizers run, cannot type the outputs of the
+    # fused contrib ops, so store the types the symbolic shape inference finds
+    optimized_model.initialize(SymbolicShapeInference.infer_shapes(optimized_model.model, auto_merge=True))
+    optimized_model.save_model_to_file(f"onnx/{name}.opt.onnx")
+    return optimized_model
+
+
+def run_with_io_binding(onnx_session, onnx_inputs):
+    io_binding = onnx_session.io_binding()
+    for input_name, arr in onnx_inputs.items():
+        io_binding.bind_ortvalue_input(input_name, onnxruntime.OrtValue.ortvalue_from_numpy(arr))
+    for output in onnx_session.get_outputs():
+        io_binding.bind_output(output.name, 'cpu')
+
+    onnx_session.run_with_iobinding(io_binding)
+    return io_binding.get_outputs()
+
+
+def convert_onnx_model_to_fp16(name, optimized_model):
+    optimized_model.convert_float_to_float16(keep_io_types=True, op_block_list=['LayerNormalization', 'SkipLayerNormalization'])
+    optimized_model.save_model_to_file(f"onnx/{name}.opt.fp16.onnx")
+
+
+def validate_encoder(optimized_model, encoder, encoder_input, padding_mask):
+    onnx_session = onnxruntime.InferenceSession(optimized_model.model.SerializeToString(), providers=['CPUExecutionProvider'])
+    with torch.no_grad():
+        cross_past_key_values = encoder(encoder_input, padding_mask)
+
+    onnx_inputs = {'input_ids': encoder_input.numpy(), 'attention_mask': padding_mask.numpy()}
+    onnx_outputs = run_with_io_binding(onnx_session, onnx_inputs)
+
+    for torch_pkv, onnx_pkv in zip(cross_past_key_values, onnx_outputs):
+        np.testing.assert_allclose(torch_pkv.numpy(), onnx_pkv.numpy(), rtol=1e-03, atol=ATOL)
+
+
+def convert_encoder(name, batch_size, max_length, validate=False):
+    model = load_model(name)
+    config = model.config
+    # torch.onnx.export puts the module back in its own mode after tracing, and a new
+    # wrapper starts in training mode, so without eval() the parity check runs with dropout
+    encoder = MarianEncoderWrapped(
+        model.model.encoder, [layer.encoder_attn for layer in model.model.decoder.layers]
+    ).eval()
+    del model
+    gc.collect()
+
+    encoder_input = torch.randint(10_000, (batch_size, max_length), dtype=torch.int32)
+    padding_mask = torch.randint(1, (batch_size, max_length), dtype=torch.int32)
+
+    encoder_inputs = (encoder_input, padding_mask)
+    encoder_input_names = ['input_ids', 'attention_mask']
+    encoder_output_names = [f"cross_pkv_{i}" for i in range(2*config.decoder_layers)]
+
+    encoder_params_names = encoder_input_names + encoder_output_names
+    size_axes = [{0 : 'batch_size', 1: 'seq_length'}]*len(encoder_input_names)
+    size_axes += [{0 : 'batch_size', 2: 'seq_length'}]*len(encoder_output_names)
+    dynamic_axes = dict(zip(encoder_params_names, size_axes))
+
+    buffer = io.BytesIO()
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            encoder_inputs,
+            buffer,
+            export_params=True,
+            opset_version=17,
+            do_constant_folding=True,
+            input_names=encoder_input_names,
+            output_names=encoder_output_names,
+            dynamic_axes=dynamic_axes)
+
+    optimized_model = optimize_exported_model("encoder", buffer, config.encoder_attention_heads, config.d_model)
+    if validate:
+        validate_encoder(optimized_model, encoder, encoder_input, padding_mask)
+
+    del encoder, buffer
+    gc.collect()
+
+    convert_onnx_model_to_fp16("encoder", optimized_model)
+    print("Encoder exported OK!")
+
+
+def validate_decoder(optimized_model, decoder, batch_size, max_length):
+    onnx_session = onnxruntime.InferenceSession(optimized_model.model.SerializeToString(), providers=['CPUExecutionProvider'])
+    pkv_names = [i.name for i in onnx_session.get_inputs() if i.name.startswith('pkv_')]
+    cross_pkv_names = [i.name for i in onnx_session.get_inputs() if i.name.startswith('cross_pkv_')]
+
+    n_heads = decoder.config.decoder_attention_heads
+    d_k = decoder.config.d_model//n_heads
+    decoder_input = torch.randint(10_000, (batch_size, 2), dtype=torch.int32)
+    encoder_hidden_states = torch.rand(batch_size, max_length, decoder.config.d_model)
+    encoder_mask = torch.ones((batch_size, max_length), dtype=torch.int32)
+
+    with torch.no_grad():
+        hidden_first, past_key_values = decoder(
+            input_ids=decoder_input[:, :1],
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_mask,
+            use_cache=True,
+            return_dict=False
+        )
+        hidden_next, _ = decoder(
+            input_ids=decoder_input[:, 1:],
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=False
+        )
+    self_past_key_values = [t for layer in past_key_values for t in layer[:2]]
+    cross_past_key_values = [t.numpy() for layer in past_key_values for t in layer[2:]]
+
+    # First step: empty self-attention cache
+    onnx_inputs = {
+        'input_ids': decoder_input[:, :1].numpy(),
+        'encoder_attention_mask': encoder_mask.numpy(),
+    }
+    onnx_inputs.update(dict.fromkeys(pkv_names, np.zeros((batch_size, n_heads, 0, d_k), np.float32)))
+    onnx_inputs.update(zip(cross_pkv_names, cross_past_key_values))
+    onnx_outputs = [arr.numpy() for arr in run_with_io_binding(onnx_session, onnx_inputs)]
+
+    np.testing.assert_allclose(hidden_first.numpy(), onnx_outputs[0], rtol=1e-03, atol=ATOL)
+    for torch_pkv, onnx_pkv in zip(self_past_key_values, onnx_outputs[1:]):
+        np.testing.assert_allclose(torch_pkv.numpy(), onnx_pkv, rtol=1e-03, atol=ATOL)
+
+    # Following steps: cached self-attention keys/values
+    onnx_inputs['input_ids'] = decoder_input[:, 1:].numpy()
+    onnx_inputs.update(zip(pkv_names, onnx_outputs[1:]))
+    onnx_outputs = run_with_io_binding(onnx_session, onnx_inputs)
+
+    np.testing.assert_allclose(hidden_next.numpy(), onnx_outputs[0].numpy(), rtol=1e-03, atol=ATOL)
+
+
+def convert_decoder(name, batch_size, max_length, validate=False):
+    model = load_model(name)
+    config = model.config
+    decoder = MarianDecoderWrapped(model.model.decoder).eval()
+    del model
+    gc.collect()
+
+    embedding_size = config.d_model
+    num_decoder_layers = config.decoder_layers
+    n_heads = config.decoder_attention_heads
+    d_k = embedding_size//n_heads
+
+    # Traced with the first-step shapes: an empty self-attention cache. The cross-attention
+    # keys/values come from the encoder and are only read, never returned
+    decoder_input = torch.randint(10_000, (batch_size, 1), dtype=torch.int32)
+    encoder_mask = torch.ones((batch_size, max_length), dtype=torch.int32)
+
+    pkv = torch.empty((batch_size, n_heads, 0, d_k), dtype=torch.float32)
+    cross_pkv = torch.empty((batch_size, n_heads, max_length, d_k), dtype=torch.float32)
+    past_key_values = ((pkv, pkv, cross_pkv, cross_pkv),)*num_decoder_layers
+    flat_past_key_values = [t for layer in past_key_values for t in layer]
+    names_past_key_values = [
+        pkv_name
+        for i in range(0, 2*num_decoder_layers, 2)
+        for pkv_name in (f"pkv_{i}", f"pkv_{i + 1}", f"cross_pkv_{i}", f"cross_pkv_{i + 1}")
+    ]
+
+    decoder_inputs_raw = [decoder_input, encoder_mask]
+    decoder_inputs = tuple(decoder_inputs_raw + flat_past_key_values)
+    decoder_input_names = ['input_ids', 'encoder_attention_mask']
+    decoder_input_names += names_past_key_values
+
+    decoder_output_names = ['output']
+    decoder_output_names += [f"pkv_{i}o" for i in range(2*num_decoder_layers)]
+    decoder_param_names = decoder_input_names + decoder_output_names
+
+    dyax_gen = [{0 : 'batch_size', 1: 'seq_length'}]
+    dyax_mask = [{0 : 'batch_size', 1: 'encoder_seq_length'}]
+    dyax_pkv = [{0 : 'batch_size', 2: 'past_seq_length'}]*2 + [{0 : 'batch_size', 2: 'encoder_seq_length'}]*2
+    dyax_present = [{0 : 'batch_size', 2: 'total_seq_length'}]*2
+    dyax = (
+        dyax_gen + dyax_mask +
+        dyax_pkv*num_decoder_layers +
+        dyax_gen +
+        dyax_present*num_decoder_layers
+    )
+    dynamic_axes = dict(zip(decoder_param_names, dyax))
+
+    buffer = io.BytesIO()
+    with torch.no_grad():
+        torch.onnx.export(
+            decoder,
+            decoder_inputs,
+            buffer,
+            export_params=True,
+            opset_version=17,
+            do_constant_folding=True,
+            input_names=decoder_input_names,
+            output_names=decoder_output_names,
+            dynamic_axes=dynamic_axes)
+
+    optimized_model = optimize_exported_model("decoder", buffer, n_heads, embedding_size)
+    if validate:
+        validate_decoder(optimized_model, decoder.decoder, batch_size, max_length)
+
+    del decoder, buffer
+    gc.collect()
+
+    convert_onnx_model_to_fp16("decoder", optimized_model)
+    print("Decoder exported OK!")
+
+
+def validate_lm_head(optimized_model, lm_head, lm_head_input):
+    onnx_session = onnxruntime.InferenceSession(optimized_model.model.SerializeToString(), providers=['CPUExecutionProvider'])
+    with torch.no_grad():
+        lm_head_output = lm_head(lm_head_input)
+
+    onnx_inputs = {'input': lm_head_input.numpy()}
+    onnx_outputs = run_with_io_binding(onnx_session, onnx_inputs)
+
+    np.testing.assert_allclose(lm_head_output.detach().numpy(), onnx_outputs[0].numpy(), rtol=1e-03, atol=ATOL)
+
+
+def convert_lm_head(name, batch_size, max_length, validate=False):
+    model = load_model(name)
+    config = model.config
+    lm_head = MarianLmHeadWrapped(model.lm_head, model.final_logits_bias).eval()
+    del model
+    gc.collect()
+
+    dummy = torch.rand if validate else torch.empty
+    lm_head_input = dummy(batch_size, 1, config.d_model)
+    lm_head_input_name = ['input']
+    lm_head_output_name = ['output']
+
+    lm_head_params_name = lm_head_input_name + lm_head_output_name
+    size_axes = [{0 : 'batch_size', 1: 'seq_length'}]*len(lm_head_params_name)
+    dynamic_axes = dict(zip(lm_head_params_name, size_axes))
+
+    buffer = io.BytesIO()
+    with torch.no_grad():
+        torch.onnx.export(
+            lm_head,
+            lm_head_input,
+            buffer,
+            export_params=True,
+            opset_version=17,
+            do_constant_folding=True,
+            input_names=lm_head_input_name,
+            output_names=lm_head_output_name,
+            dynamic_axes=dynamic_axes)
+
+    optimized_model = optimize_exported_model("lm_head", buffer, config.decoder_attention_heads, config.d_model)
+    if validate:
+        validate_lm_head(optimized_model, lm_head, lm_head_input)
+
+    del lm_head, buffer
+    gc.collect()
+
+    convert_onnx_model_to_fp16("lm_head", optimized_model)
+    print("LM Head exported OK!")
+
+
+class EncoderCalibrationDataReader(CalibrationDataReader):
+    def __init__(self, vocab_size, batch_size, max_length, num_batches=128):
+        self.batches = (
+            {
+                'input_ids': np.random.randint(vocab_size, size=(batch_size, max_length), dtype=np.int32),
+                'attention_mask': np.ones((batch_size, max_length), dtype=np.int32),
+            }
+            for _ in range(num_batches)
+        )
+
+    def get_next(self):
+        return next(self.batches, None)
 
-from src.wrappers import MarianDecoderWrapped, MarianDecoderPkvWrapped
+
+class LmHeadCalibrationDataReader(CalibrationDataReader):
+    def __init__(self, name, calibration_path):
+        # The LM head sees the decoder states after the final LayerNorm, whose learned
+        # scale and shift set their range, so calibrate on the states the fp32 graphs
+        # produce while translating the calibration text
+        translator = TranslatorOnnx(name, REGEX, variant='opt')
+        decoder_states = translator.decoder_states(read_txt(calibration_path))
+        self.batches = ({'input': decoder_state} for decoder_state in decoder_states)
+
+    def get_next(self):
+        return next(self.batches, None)
 
 
 class OnnxConverter:
@@ -19,236 +327,64 @@ class OnnxConverter:
         name,
         batch_size,
         max_length,
+        validate=False,
+        calibration_path=CALIBRATION_PATH,
     ):
-        self.model = MarianMTModel.from_pretrained(name)
-        self.config = self.model.config
-        self.encoder = self.model.model.encoder
-        self.decoder = MarianDecoderWrapped(deepcopy(self.model.model.decoder))
-        self.decoder_pkv = MarianDecoderPkvWrapped(deepcopy(self.model.model.decoder))
-
-        lm_head_input_size = self.model.lm_head.weight.shape[0]
-        lm_head_output_size = self.model.lm_head.weight.shape[1]
-        self.lm_head = torch.nn.Linear(lm_head_input_size, lm_head_output_size, bias=True)
-        self.lm_head.weight.data = self.model.lm_head.weight
-        self.lm_head.bias.data = self.model.final_logits_bias
+        self.name = name
+        self.config = MarianConfig.from_pretrained(name)
 
         self.batch_size = batch_size
         self.max_length = max_length
-        self.embedding_size = self.config.d_model
-
-        self.num_decoder_layers = self.config.num_hidden_layers
-        self.n_heads = self.config.decoder_attention_heads
-        self.d_k = self.embedding_size//self.n_heads
-
-    def _convert_encoder(self):
-        encoder_input = torch.randint(10_000, (self.batch_size, self.max_length))
-        padding_mask = torch.randint(1, (self.batch_size, self.max_length))
-
-        encoder_inputs = (encoder_input, padding_mask)
-        encoder_input_names = ['input_ids', 'attention_mask']
-        encoder_output_names = ['output']
-
-        encoder_params_names = encoder_input_names + encoder_output_names
-        size_axes = [{0 : 'batch_size', 1: 'seq_length'}]*len(encoder_params_names)
-        dynamic_axes = dict(zip(encoder_params_names, size_axes))
-
-        with torch.no_grad():
-            encoder_hidden_state = self.encoder(encoder_input, padding_mask, return_dict=False)
-            torch.onnx.export(
-                self.encoder,
-                encoder_inputs,
-                "onnx/encoder.onnx",
-                export_params=True,
-                opset_version=11,
-                do_constant_folding=True,
-                input_names=encoder_input_names,
-                output_names=encoder_output_names,
-                dynamic_axes=dynamic_axes)
-
-        onnx_session = onnxruntime.InferenceSession("onnx/encoder.onnx")
-        onnx_inputs = dict(zip(encoder_input_names, [arr.numpy() for arr in encoder_inputs]))
-        onnx_outputs = onnx_session.run(None, onnx_inputs)
-
-        np.testing.assert_allclose(encoder_hidden_state[0].detach().numpy(), onnx_outputs[0], rtol=1e-03, atol=1e-05)
-        print("Encoder exported OK!")
-
-    def _convert_decoder(self):
-        decoder_input = torch.randint(10_000, (self.batch_size, self.max_length))
-        encoder_hidden_states = torch.rand(self.batch_size, self.max_length, self.embedding_size)
-        encoder_mask = torch.randint(1, (self.batch_size, self.max_length))
-
-        decoder_inputs = (decoder_input, encoder_hidden_states, encoder_mask)
-        decoder_input_names = ['input_ids','encoder_hidden_states', 'encoder_attention_mask']
-        decoder_output_names = ['output']
-        decoder_output_names += [f"pkv_{i}" for i in range(24)]
-
-        decoder_params_names = decoder_input_names + decoder_output_names
-        size_axes = [{0 : 'batch_size', 1: 'seq_length'}]*4 + [{0 : 'batch_size', 2: 'seq_length'}]*24
-        dynamic_axes = dict(zip(decoder_params_names, size_axes))
-
-        with torch.no_grad():
-            decoder_hidden_states = self.decoder(*decoder_inputs)
-            torch.onnx.export(
-                self.decoder,
-                decoder_inputs,
-                "onnx/decoder.onnx",
-                export_params=True,
-                opset_version=11,
-                do_constant_folding=True,
-                input_names=decoder_input_names,
-                output_names=decoder_output_names,
-                dynamic_axes=dynamic_axes)
-
-        onnx_session = onnxruntime.InferenceSession("onnx/decoder.onnx")
-        onnx_inputs = dict(zip(decoder_input_names, [arr.numpy() for arr in decoder_inputs]))
-        onnx_outputs = onnx_session.run(None, onnx_inputs)
-
-        np.testing.assert_allclose(decoder_hidden_states[0].detach().numpy(), onnx_outputs[0], rtol=1e-03, atol=1e-05)
-        print("Decoder exported OK!")
-
-    def _convert_decoder_pkv(self):
-        decoder_input = torch.randint(10_000, (self.batch_size, 1))
-        encoder_hidden_states = torch.rand(self.batch_size, self.max_length, self.embedding_size)
-        encoder_mask = torch.randint(1, (self.batch_size, self.max_length))
-
-        pkv = torch.ones((self.batch_size, self.n_heads, self.max_length, self.d_k), dtype=torch.float32)
-        past_key_values = ((pkv, pkv, pkv, pkv),)*self.num_decoder_layers
-        flat_past_key_values = functools.reduce(operator.iconcat, past_key_values, [])
-        names_past_key_values = [f"pkv_{i}" for i in range(len(flat_past_key_values))]
-
-        decoder_inputs_raw = [decoder_input, encoder_hidden_states, encoder_mask]
-        decoder_inputs = tuple(decoder_inputs_raw + flat_past_key_values)
-        decoder_input_names = ['input_ids', 'encoder_hidden_states', 'encoder_attention_mask']
-        decoder_input_names += names_past_key_values
-
-        decoder_output_names = ['output']
-        for i in range(len(names_past_key_values)):
-            if (i//2)%2 != 0:
-                name = names_past_key_values[i]
-                decoder_output_names.append(name)
-            else:
-                name = names_past_key_values[i] + 'o'
-                decoder_output_names.append(name)
-        decoder_param_names = decoder_input_names + decoder_output_names
-
-        dyax_gen = [{0 : 'batch_size', 1: 'seq_length'}]
-        dyax_pkv = [{0 : 'batch_size', 2: 'seq_length'}]
-        dyax = (
-            dyax_gen*len(decoder_inputs_raw) +
-            dyax_pkv*len(flat_past_key_values) +
-            dyax_gen +
-            dyax_pkv*len(flat_past_key_values)
-        )
-        dynamic_axes = dict(zip(decoder_param_names, dyax))
-
-        with torch.no_grad():
-            decoder_hidden_states = self.decoder_pkv(*decoder_inputs)
-            torch.onnx.export(
-                self.decoder_pkv,
-                decoder_inputs,
-                "onnx/decoder_pkv.onnx",
-                export_params=True,
-                opset_version=11,
-                do_constant_folding=True,
-                input_names=decoder_input_names,
-                output_names=decoder_output_names,
-                dynamic_axes=dynamic_axes)
-
-        onnx_session = onnxruntime.InferenceSession("onnx/decoder_pkv.onnx")
-        onnx_inputs = dict(zip(decoder_input_names, [arr.numpy() for arr in decoder_inputs]))
-        onnx_inputs.pop('encoder_hidden_states')
-        onnx_outputs = onnx_session.run(None, onnx_inputs)
-
-        np.testing.assert_allclose(decoder_hidden_states[0].detach().numpy(), onnx_outputs[0], rtol=1e-03, atol=1e-05)
-        print("Decoder PKV exported OK!")
-
-    def _convert_lm_head(self):
-        lm_head_input = torch.rand(self.batch_size, 1, self.embedding_size)
-        lm_head_input_name = ['input']
-        lm_head_output_name = ['output']
-
-        lm_head_params_name = lm_head_input_name + lm_head_output_name
-        size_axes = [{0 : 'batch_size', 1: 'seq_length'}]*len(lm_head_params_name)
-        dynamic_axes = dict(zip(lm_head_params_name, size_axes))
-
-        with torch.no_grad():
-            lm_head_output = self.lm_head(lm_head_input)
-            torch.onnx.export(
-                self.lm_head,
-                lm_head_input,
-                "onnx/lm_head.onnx",
-                export_params=True,
-                opset_version=11,
-                do_constant_folding=True,
-                input_names=lm_head_input_name,
-                output_names=lm_head_output_name,
-                dynamic_axes=dynamic_axes)
-
-        onnx_session = onnxruntime.InferenceSession("onnx/lm_head.onnx")
-        onnx_inputs = {'input': lm_head_input.numpy()}
-        onnx_outputs = onnx_session.run(None, onnx_inputs)
-
-        np.testing.assert_allclose(lm_head_output.detach().numpy(), onnx_outputs[0], rtol=1e-03, atol=1e-05)
-        print("LM Head exported OK!")
+        self.validate = validate
+        self.calibration_path = calibration_path
 
     def convert_to_onnx(self):
-        self._convert_encoder()
-        self._convert_decoder()
-        self._convert_decoder_pkv()
-        self._convert_lm_head()
-
+        converters = [convert_encoder, convert_decoder, convert_lm_head]
+        # Split the cores this process may run on between the workers instead of letting
+        # each torch spawn one thread per core
+        if hasattr(os, 'sched_getaffinity'):
+            num_cpus = len(os.sched_getaffinity(0))
+        else:
+            num_cpus = os.cpu_count() or 1
+        num_threads = max(1, num_cpus//len(converters))
+        with ProcessPoolExecutor(
+            max_workers=len(converters), initializer=torch.set_num_threads, initargs=(num_threads,)
+        ) as executor:
+            futures = [
+                executor.submit(converter, self.name, self.batch_size, self.max_length, self.validate)
+                for converter in converters
+            ]
+        for future in futures:
+            future.result()
 
-    def optimize_onnx_model(self):
-        sess_options = onnxruntime.SessionOptions()
-        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-
-        sess_options.optimized_model_filepath = "onnx/encoder.opt.onnx"
-        _ = onnxruntime.InferenceSession("onnx/encoder.onnx", sess_options)
-
-        sess_options.optimized_model_filepath = "onnx/decoder.opt.onnx"
-        _ = onnxruntime.InferenceSession("onnx/decoder.onnx", sess_options)
-
-        sess_options.optimized_model_filepath = "onnx/decoder_pkv.opt.onnx"
-        _ = onnxruntime.InferenceSession("onnx/decoder_pkv.onnx", sess_options)
-
-        sess_options.optimized_model_filepath = "onnx/lm_head.opt.onnx"
-        _ = onnxruntime.InferenceSession("onnx/lm_head.onnx", sess_options)
-    
     def quantize_onnx_model(self):
-        encoder = onnx.load("onnx/encoder.opt.onnx")
-        decoder = onnx.load("onnx/decoder.opt.onnx")
-        decoder_pkv = onnx.load("onnx/decoder_pkv.opt.onnx")
-        lm_head = onnx.load("onnx/lm_head.opt.onnx")
-
-        encoder_quant = quantize(
-            model=encoder,
-            quantization_mode=QuantizationMode.IntegerOps,
-            force_fusions=True,
-            symmetric_weight=True,
+        quantize_static(
+            model_input="onnx/encoder.opt.onnx",
+            model_output="onnx/encoder.opt.quant.onnx",
+            calibration_data_reader=EncoderCalibrationDataReader(
+                self.config.vocab_size, self.batch_size, self.max_length
+            ),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
         )
 
-        decoder_quant = quantize(
-            model=decoder,
-            quantization_mode=QuantizationMode.IntegerOps,
-            force_fusions=True,
-            symmetric_weight=True,
+        quantize_dynamic(
+            "onnx/decoder.opt.onnx",
+            "onnx/decoder.opt.quant.onnx",
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            reduce_range=False,
+            op_types_to_quantize=['MatMul', 'Gemm', 'Attention'],
         )
 
-        decoder_pkv_quant = quantize(
-            model=decoder_pkv,
-            quantization_mode=QuantizationMode.IntegerOps,
-            force_fusions=True,
-            symmetric_weight=True,
+        quantize_static(
+            model_input="onnx/lm_head.opt.onnx",
+            model_output="onnx/lm_head.opt.quant.onnx",
+            calibration_data_reader=LmHeadCalibrationDataReader(self.name, self.calibration_path),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
         )
-
-        lm_head_quant = quantize(
-            model=lm_head,
-            quantization_mode=QuantizationMode.IntegerOps,
-            force_fusions=True,
-            symmetric_weight=True,
-        )
-
-        onnx.save_model(encoder_quant, "onnx/encoder.opt.quant.onnx")
-        onnx.save_model(decoder_quant, "onnx/decoder.opt.quant.onnx")
-        onnx.save_model(decoder_pkv_quant, "onnx/decoder_pkv.opt.quant.onnx")
-        onnx.save_model(lm_head_quant, "onnx/lm_head.opt.quant.onnx")
@@ -2,36 +2,27 @@ import itertools
 import torch
 
 
-class MarianDecoderWrapped(torch.nn.Module):
-    def __init__(self, decoder):
-        super(MarianDecoderWrapped, self).__init__()
-        self.decoder = decoder
+class MarianEncoderWrapped(torch.nn.Module):
+    def __init__(self, encoder, cross_attentions):
+        super(MarianEncoderWrapped, self).__init__()
+        self.encoder = encoder
+        self.cross_attentions = torch.nn.ModuleList(cross_attentions)
 
-    def forward(
-        self,
-        input_ids,
-        encoder_hidden_states,
-        encoder_attention_mask
-    ):
-        return self.decoder(
-            input_ids=input_ids,
-            attention_mask=None,
-            encoder_hidden_states=encoder_hidden_states,
-            encoder_attention_mask=encoder_attention_mask,
-            head_mask=None,
-            cross_attn_head_mask=None,
-            past_key_values=None,
-            inputs_embeds=None,
-            use_cache=None,
-            output_attentions=None,
-            output_hidden_states=None,
-            return_dict=False
+    def forward(self, input_ids, attention_mask):
+        # The decoder only sees the encoder output through the cross-attention keys/values,
+        # so project it here once instead of carrying the projections through every step
+        hidden_states = self.encoder(input_ids, attention_mask, return_dict=False)[0]
+        bsz = hidden_states.shape[0]
+        return tuple(
+            attention._shape(projection(hidden_states), -1, bsz)
+            for attention in self.cross_attentions
+            for projection in (attention.k_proj, attention.v_proj)
         )
 
 
-class MarianDecoderPkvWrapped(torch.nn.Module):
+class MarianDecoderWrapped(torch.nn.Module):
     def __init__(self, decoder):
-        super(MarianDecoderPkvWrapped, self).__init__()
+        super(MarianDecoderWrapped, self).__init__()
         self.decoder = decoder
 
     def group(self, lst):
@@ -40,23 +31,38 @@ class MarianDecoderPkvWrapped(torch.nn.Module):
     def forward(
         self,
         input_ids,
-        encoder_hidden_states,
         encoder_attention_mask,
         *past_key_values
     ):
         past_key_values = self.group(past_key_values)
+        # With the cross-attention cache set, the Marian layers only compare its length
+        # with encoder_hidden_states, so hand them a view whose length matches the cache
+        cross_attention_states = past_key_values[0][2].transpose(1, 2)
 
-        return self.decoder(
+        hidden_states, next_cache = self.decoder(
             input_ids=input_ids,
             attention_mask=None,
-            encoder_hidden_states=encoder_hidden_states,
+            encoder_hidden_states=cross_attention_states,
             encoder_attention_mask=encoder_attention_mask,
             head_mask=None,
             cross_attn_head_mask=None,
             past_key_values=past_key_values,
             inputs_embeds=None,
-            use_cache=None,
+            use_cache=True,
             output_attentions=None,
             output_hidden_states=None,
             return_dict=False
         )
+        # The cross-attention keys/values are the ones passed in, so only the
+        # self-attention cache is returned
+        return hidden_states, tuple(layer[:2] for layer in next_cache)
+
+
+class MarianLmHeadWrapped(torch.nn.Module):
+    def __init__(self, lm_head, final_logits_bias):
+        super(MarianLmHeadWrapped, self).__init__()
+        self.lm_head = lm_head
+        self.register_buffer('final_logits_bias', final_logits_bias)
+
+    def forward(self, hidden_states):
+        return self.lm_head(hidden_states) + self.final_logits_bias